@@ -5,14 +5,15 @@
 
 # DeepSpeed Team
 
-from functools import partial
 import argparse
-import glob
 import itertools
 import multiprocessing
+import numpy as np
 import os
+import psutil
 import re
 import shutil
+import tempfile
 import torch
 import tqdm
 # from pprint import pprint
@@ -35,6 +36,25 @@ from deepspeed.checkpoint import (
     PARAMETER_TO_AVERAGE_PATTERNS,
     PARAMETER_WITH_ROW_PARALLELISM_PATTERNS,
 )
+from deepspeed.runtime.utils import required_torch_version
+
+# dtype of the raw fragment files written during extraction; optimizer states are kept in fp32
+SHARD_DTYPE = torch.float32
+# exp_avg and exp_avg_sq may be stored at lower precision, see --moment_dtype
+MOMENT_DTYPES = {'fp32': torch.float32, 'bf16': torch.bfloat16}
+# numpy has no bfloat16, so it is memory-mapped through the same-sized int16
+_NUMPY_DTYPES = {torch.float32: np.float32, torch.bfloat16: np.int16}
+
+ZERO_STATES = ("fp32", "exp_avg", "exp_avg_sq")
+
+# tmpfs mount used for --in_memory; shard files placed there are plain shared memory pages
+SHARED_MEMORY_FOLDER = '/dev/shm'
+
+# number of elements compared across tp replicas unless --strict_replica_check is given
+REPLICA_CHECK_SAMPLES = 4096
+
+# read-only state shared with pool workers, populated once per worker by _init_worker
+_WORKER_STATE = {}
 
 
 def parse_arguments():
@@ -52,6 +72,18 @@ def parse_arguments():
         help=
         'How many parallel processes to merge tp slices (more memory intensive, use much fewer than --num_extract_workers))'
     )
+    parser.add_argument('--strict_replica_check',
+                        action='store_true',
+                        help='Compare tp replicated parameters in full instead of on a sample of their elements.')
+    parser.add_argument('--moment_dtype',
+                        default='fp32',
+                        choices=sorted(MOMENT_DTYPES.keys()),
+                        help='Precision of the intermediate exp_avg and exp_avg_sq slice files. '
+                        'bf16 halves their size; the merged states are fp32 either way.')
+    parser.add_argument('--in_memory',
+                        action='store_true',
+                        help='Keep the intermediate checkpoint slice files in shared memory instead of on disk, '
+                        'if enough memory is available.')
     parser.add_argument('--keep_temp_folder',
                         action='store_true',
                         help='Preserve temporary folder of intermediate checkpoint slice files. Useful for debugging.')
@@ -73,13 +105,70 @@ def _create_checkpoint_paths(base_folder, iteration, tp_degree, pp_degree):
     return path_list
 
 
+def _load_model_states(mp_rank_file):
+    # Only PARAM_SHAPES is needed from the model states, which may also hold all the module weights.
+    # Memory-mapping the file leaves those on disk instead of reading them in.
+    if required_torch_version(min_version=2.1):
+        return torch.load(mp_rank_file, map_location=torch.device('cpu'), mmap=True)
+    return torch.load(mp_rank_file, map_location=torch.device('cpu'))
+
+
 def _save_checkpoint(file_path, chkpt_sd):
     dir, _ = os.path.split(file_path)
     os.makedirs(dir, exist_ok=True)
     torch.save(chkpt_sd, file_path)
 
 
-def extract_zero_shards(dir, ds_checkpoint, indices_3D):
+def _compile_patterns(patterns):
+    return [re.compile(pattern) for pattern in patterns]
+
+
+def _matches_any(compiled_patterns, name):
+    return any(pattern.match(name) for pattern in compiled_patterns)
+
+
+def _get_parameter_patterns(universal_checkpoint_info):
+    pattern_keys = [
+        VOCABULARY_PARAMETER_PATTERNS, PIPELINE_REPLICATED_PARAMETER_PATTERNS, TP_REPLICATED_PARAMETER_PATTERNS,
+        PARAMETER_TO_AVERAGE_PATTERNS, PARAMETER_WITH_ROW_PARALLELISM_PATTERNS
+    ]
+    return {key: _compile_patterns(universal_checkpoint_info.get(key, [])) for key in pattern_keys}
+
+
+def _get_param_layout(param_shapes):
+    """Start offset and numel of every parameter within its (unpartitioned) flattened param group."""
+    layout = []
+    for group_shapes in param_shapes:
+        group_layout = {}
+        start = 0
+        for name, shape in group_shapes.items():
+            numel = torch.Size(shape).numel()
+            group_layout[name] = (start, numel)
+            start += numel
+        layout.append(group_layout)
+
+    return layout
+
+
+def _get_param_offset(fragment_mapping, param_start, param_numel, dp_index, dp_degree, partition_size):
+    if fragment_mapping.start > 0:
+        # fragment begins its parameter
+        param_offset = 0
+    elif dp_index == dp_degree - 1:
+        # padding is stripped from the last partition, so its size can't be trusted,
+        # but every fragment it holds ends its parameter
+        param_offset = param_numel - fragment_mapping.numel
+    else:
+        param_offset = dp_index * partition_size - param_start
+
+    assert 0 <= param_offset and param_offset + fragment_mapping.numel <= param_numel
+    return param_offset
+
+
+def extract_zero_shards(indices_3D):
+    dir = _WORKER_STATE['temp_dir']
+    ds_checkpoint = _WORKER_STATE['ds_checkpoint']
+    param_layouts = _WORKER_STATE['param_layouts']
     pp_index, tp_index, dp_index = indices_3D
     sd = ds_checkpoint.get_zero_checkpoint_state(pp_index=pp_index, tp_index=tp_index, dp_index=dp_index)
 
@@ -87,8 +176,7 @@ def extract_zero_shards(dir, ds_checkpoint, indices_3D):
 
     optim_sd = sd[OPTIMIZER_STATE_DICT]
     param_slice_mappings = optim_sd[PARAM_SLICE_MAPPINGS]
-    universal_checkpoint_info = ds_checkpoint.get_checkpoint_info(UNIVERSAL_CHECKPOINT_INFO)
-    pipeline_replicated_params = universal_checkpoint_info.get(PIPELINE_REPLICATED_PARAMETER_PATTERNS, [])
+    pipeline_replicated_params = _WORKER_STATE['parameter_patterns'][PIPELINE_REPLICATED_PARAMETER_PATTERNS]
     # print(f'{pipeline_replicated_params=}')
 
     # dict
@@ -96,7 +184,12 @@ def extract_zero_shards(dir, ds_checkpoint, indices_3D):
     # list
     fp32_groups = optim_sd[SINGLE_PARTITION_OF_FP32_GROUPS]
     param_groups_cnt = len(state_groups)
+    param_layout = param_layouts[pp_index]
+    tp_degree = ds_checkpoint.tp_degree
+    dtypes = _get_shard_dtypes(_WORKER_STATE['moment_dtype'])
 
+    # (name, numel) of every extracted fragment, for the parent to track which parameters are complete
+    extracted = []
     for param_group_id in range(param_groups_cnt):
 
         flat_state = dict(
@@ -104,49 +197,145 @@ def extract_zero_shards(dir, ds_checkpoint, indices_3D):
             exp_avg_sq=state_groups[param_group_id]["exp_avg_sq"],
             fp32=fp32_groups[param_group_id],
         )
+        partition_size = fp32_groups[param_group_id].numel()
 
+        fragments = []
         for name, fragment_mapping in param_slice_mappings[param_group_id].items():
-            if pp_index > 0 and any(re.match(pattern, name) for pattern in pipeline_replicated_params):
+            if pp_index > 0 and _matches_any(pipeline_replicated_params, name):
                 # Skip tied weights that are replicated in first and last pp stages
                 continue
 
             # pprint(f"dpt{dp_index}{pp_index}{tp_index} {param_group_id} {name} => {fragment_mapping.start}:{fragment_mapping.numel}")
-            for state_key in flat_state.keys():
-                dump_param_fragment(dir, tp_index, dp_index, state_key, flat_state[state_key], name,
-                                    fragment_mapping.start, fragment_mapping.numel)
+            param_start, param_numel = param_layout[param_group_id][name]
+            param_offset = _get_param_offset(fragment_mapping, param_start, param_numel, dp_index,
+                                             ds_checkpoint.dp_degree, partition_size)
+            # the tp slices of a parameter are stored back to back in one shard file
+            fragments.append((name, tp_degree * param_numel, tp_index * param_numel + param_offset, fragment_mapping))
+            extracted.append((name, fragment_mapping.numel))
+
+        # carve every state into all of its fragments with a single split instead of a narrow per fragment
+        fragments.sort(key=lambda fragment: fragment[-1].start)
+        split_sizes, split_end = _get_fragment_split_sizes([fragment[-1] for fragment in fragments])
+        state_pieces = {}
+        for state_key, state_flat_tensor in flat_state.items():
+            if torch.count_nonzero(state_flat_tensor) == 0:
+                # e.g. optimizer moments before the first step; shard regions left unwritten read back as zeros
+                continue
+            pieces = state_flat_tensor.split(split_sizes + [state_flat_tensor.numel() - split_end])
+            state_pieces[state_key] = pieces[1::2]
+
+        for i, (name, shard_numel, shard_offset, _) in enumerate(fragments):
+            state_fragments = {state_key: pieces[i] for state_key, pieces in state_pieces.items()}
+            dump_param_fragment(dir, name, state_fragments, shard_numel, shard_offset, dtypes)
+
+    return extracted
+
+
+def _get_fragment_split_sizes(fragment_mappings):
+    """Sizes splitting a flat partition into the given (start-ordered) fragments, each preceded by its gap."""
+    split_sizes = []
+    end = 0
+    for fragment_mapping in fragment_mappings:
+        split_sizes += [fragment_mapping.start - end, fragment_mapping.numel]
+        end = fragment_mapping.start + fragment_mapping.numel
+
+    return split_sizes, end
+
+
+def _get_shard_path(dir, param_name):
+    # a flat layout needs no per-parameter folders
+    return os.path.join(dir, param_name)
+
+
+def _get_itemsize(dtype):
+    return np.dtype(_NUMPY_DTYPES[dtype]).itemsize
 
 
-cnt = 0
+def _get_shard_dtypes(moment_dtype):
+    return {state: SHARD_DTYPE if state == "fp32" else moment_dtype for state in ZERO_STATES}
 
 
-def dump_param_fragment(dir, tp_index, dp_index, state_name, state_flat_tensor, param_name, offset, numel):
+def _get_shard_layout(shard_numel, dtypes):
+    """Byte offset of every state's region within a parameter's shard file, and the size of the file."""
+    region_offsets = {}
+    nbytes = 0
+    for state in ZERO_STATES:
+        region_offsets[state] = nbytes
+        nbytes += shard_numel * _get_itemsize(dtypes[state])
 
-    global cnt  # temp hack
+    return region_offsets, nbytes
 
-    param_base_path = os.path.join(dir, param_name, str(tp_index))
-    os.makedirs(param_base_path, exist_ok=True)
 
-    cnt += 1
-    counter = f"{dp_index:0>2d}"
+def _create_shard_file(path, nbytes):
+    # grow, never shrink, the file so that concurrent writers don't lose each other's fragments
+    with open(path, 'ab') as f:
+        if f.tell() < nbytes:
+            f.truncate(nbytes)
 
-    path = os.path.join(param_base_path, f"{state_name}.{counter}")
 
-    #print(f"{param_name}: {offset}: {numel} => {path}")
+def _map_shard(path, dtype, mode, byte_offset, numel):
+    """Memory-map numel elements of a raw shard file, starting at byte_offset, as a tensor."""
+    array = np.memmap(path, dtype=_NUMPY_DTYPES[dtype], mode=mode, offset=byte_offset, shape=(numel, ))
+    return torch.from_numpy(array).view(dtype)
 
-    t = state_flat_tensor.narrow(0, offset, numel).clone()
-    _save_checkpoint(path, t)
 
+def dump_param_fragment(dir, param_name, state_fragments, shard_numel, shard_offset, dtypes):
+    if not state_fragments:
+        return
 
-def _merge_zero_shards(param_base_path, state, tp_degree, slice_shape):
-    slices = []
-    for tp_index in range(tp_degree):
-        prefix_path = os.path.join(param_base_path, str(tp_index), f"{state}")
-        paths = sorted(list(glob.glob(f"{prefix_path}.*")))
-        shards = [torch.load(p) for p in paths]
-        slice = torch.cat(shards, dim=0).reshape(slice_shape)
-        slices.append(slice)
+    path = _get_shard_path(dir, param_name)
 
-    return slices
+    # All ranks write their fragments in place into a single file holding every state and tp slice of the
+    # parameter, instead of pickling every fragment into a file of its own. Only the fragments' windows are mapped.
+    region_offsets, nbytes = _get_shard_layout(shard_numel, dtypes)
+    _create_shard_file(path, nbytes)
+    for state_name, fragment in state_fragments.items():
+        byte_offset = region_offsets[state_name] + shard_offset * _get_itemsize(dtypes[state_name])
+        _map_shard(path, dtypes[state_name], 'r+', byte_offset, fragment.numel()).copy_(fragment)
+
+
+def _merge_zero_shards(slice_dir, name, tp_degree, slice_shape, dtypes):
+    """Map every state region of a parameter's shard file, viewed as its tp_degree stacked slices."""
+    shard_shape = (tp_degree, ) + tuple(slice_shape)
+    path = _get_shard_path(slice_dir, name)
+    if not os.path.exists(path):
+        # no rank had a nonzero fragment of this parameter
+        return {state: torch.zeros(shard_shape, dtype=SHARD_DTYPE) for state in ZERO_STATES}
+
+    shard_numel = torch.Size(shard_shape).numel()
+    region_offsets, _ = _get_shard_layout(shard_numel, dtypes)
+    state_shards = {}
+    for state in ZERO_STATES:
+        shard = _map_shard(path, dtypes[state], 'c', region_offsets[state], shard_numel).reshape(shard_shape)
+        # states stored at lower precision are restored to fp32
+        state_shards[state] = shard.to(SHARD_DTYPE)
+
+    return state_shards
+
+
+def _check_replicated_slices(slices, strict):
+    if strict:
+        assert all([slices[0].equal(other_slice) for other_slice in slices[1:]])
+        return
+
+    # compare evenly spaced samples rather than reading every replica in full; the indices are computed with
+    # integer arithmetic, float32 cannot represent every index of a parameter with 2**24 or more elements
+    numel = slices[0].numel()
+    steps = min(numel, REPLICA_CHECK_SAMPLES)
+    index = torch.arange(steps) * (numel - 1) // max(steps - 1, 1)
+    sample = slices[0].reshape(-1).index_select(0, index)
+    assert all([sample.equal(other_slice.reshape(-1).index_select(0, index)) for other_slice in slices[1:]])
+
+
+def _average_slices(slices):
+    # accumulate in place rather than through sum(), which allocates a new tensor per addition
+    dtype = slices[0].dtype
+    param = torch.zeros_like(slices[0], dtype=torch.float32)
+    for slice in slices:
+        param.add_(slice)
+    param.div_(len(slices))
+
+    return param.to(dtype)
 
 
 def _get_vocab_divisibility_padding_tensor(universal_checkpoint_info, padded_vocab_tensor):
@@ -157,38 +346,58 @@ def _get_vocab_divisibility_padding_tensor(universal_checkpoint_info, padded_voc
         return torch.zeros(padded_vocab_tensor.shape[1])
 
 
-def merge_tp_slices(ds_checkpoint, dir, slice_dir, tp_degree, name_and_shape):
+def merge_tp_slices(name_and_shape):
+    ds_checkpoint = _WORKER_STATE['ds_checkpoint']
+    dir = _WORKER_STATE['output_dir']
+    slice_dir = _WORKER_STATE['temp_dir']
+    tp_degree = ds_checkpoint.tp_degree
+    strict_replica_check = _WORKER_STATE['strict_replica_check']
     name, shape = name_and_shape
-    slice_base_path = os.path.join(slice_dir, name)
     param_base_path = os.path.join(dir, name)
 
-    universal_checkpoint_info = ds_checkpoint.get_checkpoint_info(UNIVERSAL_CHECKPOINT_INFO)
-    replicated_parameters = universal_checkpoint_info.get(TP_REPLICATED_PARAMETER_PATTERNS, [])
-    parameters_to_average = universal_checkpoint_info.get(PARAMETER_TO_AVERAGE_PATTERNS, [])
-    parameters_with_row_parallelism = universal_checkpoint_info.get(PARAMETER_WITH_ROW_PARALLELISM_PATTERNS, [])
-    vocabulary_parameters = universal_checkpoint_info.get(VOCABULARY_PARAMETER_PATTERNS, [])
-    for state in ("fp32", "exp_avg", "exp_avg_sq"):
-        slices = _merge_zero_shards(slice_base_path, state, tp_degree, shape)
+    universal_checkpoint_info = _WORKER_STATE['universal_checkpoint_info']
+    parameter_patterns = _WORKER_STATE['parameter_patterns']
+    replicated_parameters = parameter_patterns[TP_REPLICATED_PARAMETER_PATTERNS]
+    parameters_to_average = parameter_patterns[PARAMETER_TO_AVERAGE_PATTERNS]
+    parameters_with_row_parallelism = parameter_patterns[PARAMETER_WITH_ROW_PARALLELISM_PATTERNS]
+    vocabulary_parameters = parameter_patterns[VOCABULARY_PARAMETER_PATTERNS]
+
+    # how a parameter is merged doesn't depend on the state, so classify it only once
+    is_replicated = _matches_any(replicated_parameters, name)
+    is_averaged = _matches_any(parameters_to_average, name)
+    is_row_parallel = _matches_any(parameters_with_row_parallelism, name)
+    is_vocabulary = _matches_any(vocabulary_parameters, name)
+    dtypes = _get_shard_dtypes(_WORKER_STATE['moment_dtype'])
+    state_shards = _merge_zero_shards(slice_dir, name, tp_degree, shape, dtypes)
+    for state in ZERO_STATES:
+        shard = state_shards.pop(state)
+        slices = list(shard.unbind(0))
         final_path = os.path.join(param_base_path, f"{state}.pt")
 
         #print(f"Expected shape: {shape}")
         #print(f"Fragment sizes:", list(frag.shape for frag in slices))
         ckpt_dict = {}
-        if any(re.match(pattern, name) for pattern in replicated_parameters):
+        if is_replicated:
             if len(slices) > 1:
-                assert all([slices[0].equal(other_slice) for other_slice in slices[1:]])
-            param = slices[0]
+                _check_replicated_slices(slices, strict_replica_check)
+            # clone, as saving a view would also save the other slices sharing its storage
+            param = slices[0].clone()
             # print(f'replicate {name} using first slice')
-        elif any(re.match(pattern, name) for pattern in parameters_to_average):
-            param = sum(slices) / len(slices)
+        elif is_averaged:
+            param = _average_slices(slices)
             # print(f'merge {name} using average')
         else:
-            cat_dim = 1 if any(re.match(pattern, name) for pattern in parameters_with_row_parallelism) else 0
+            cat_dim = 1 if is_row_parallel else 0
             # print(f"merge {name} with CAT DIM: {cat_dim}")
-            param = torch.cat(slices, dim=cat_dim)
+            if cat_dim == 0:
+                # the slices are already laid out back to back in the shard
+                param = shard.reshape((-1, ) + tuple(shape[1:]))
+            else:
+                # the slices are views into the mapped shard, so concatenating them is the only copy
+                param = torch.cat(slices, dim=cat_dim)
             ckpt_dict[CAT_DIM] = cat_dim
 
-        if any(re.match(pattern, name) for pattern in vocabulary_parameters):
+        if is_vocabulary:
             #print(f"Before {param.shape=}")
             # strip padding
             #param = _strip_vocab_padding(ds_checkpoint, param)
@@ -201,38 +410,102 @@ def merge_tp_slices(ds_checkpoint, dir, slice_dir, tp_degree, name_and_shape):
         _save_checkpoint(final_path, ckpt_dict)
 
 
-def _get_chunks(l, n):
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
+def _init_worker(worker_state):
+    _WORKER_STATE.update(worker_state)
+
+
+def _create_pool(num_workers, worker_state):
+    # forked workers inherit worker_state once instead of unpickling it with every task
+    if 'fork' in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context('fork')
+    else:
+        mp_context = multiprocessing.get_context()
+
+    return mp_context.Pool(num_workers, initializer=_init_worker, initargs=(worker_state, ))
 
 
-def _do_parallel_work(do_work, work_chunks, num_workers):
-    pool = multiprocessing.Pool(num_workers)
-    for batch in tqdm.tqdm(work_chunks):
-        pool.map(do_work, batch)
-    pool.close()
-    pool.join()
+def _get_temp_folder(args, slice_shapes, tp_degree):
+    temp_dir = os.path.join(args.output_folder, 'tmp')
+    if not args.in_memory:
+        return temp_dir
+
+    if not os.path.isdir(SHARED_MEMORY_FOLDER):
+        print(f'{SHARED_MEMORY_FOLDER} is not available, extracting ZeRO fragments to {temp_dir}')
+        return temp_dir
 
+    shard_numel = sum(torch.Size(shape).numel() for shape in slice_shapes.values()) * tp_degree
+    _, shard_bytes = _get_shard_layout(shard_numel, _get_shard_dtypes(MOMENT_DTYPES[args.moment_dtype]))
+    available_bytes = min(psutil.virtual_memory().available, shutil.disk_usage(SHARED_MEMORY_FOLDER).free)
+    if shard_bytes > available_bytes:
+        print(f'ZeRO fragments need {shard_bytes} bytes but only {available_bytes} bytes of memory are available, '
+              f'extracting them to {temp_dir}')
+        return temp_dir
 
-def _extract_zero_shard_files(args, ds_checkpoint, temp_dir):
+    return tempfile.mkdtemp(prefix='ds_to_universal_', dir=SHARED_MEMORY_FOLDER)
+
+
+def _create_temp_folder(temp_dir):
+    # shards are written sparsely, so files left over from an earlier run must not be reused
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+
+
+def _get_worker_state(ds_checkpoint, **kwargs):
+    universal_checkpoint_info = ds_checkpoint.get_checkpoint_info(UNIVERSAL_CHECKPOINT_INFO)
+    return dict(ds_checkpoint=ds_checkpoint,
+                universal_checkpoint_info=universal_checkpoint_info,
+                parameter_patterns=_get_parameter_patterns(universal_checkpoint_info),
+                **kwargs)
+
+
+def _convert_zero_shard_files(args, ds_checkpoint, param_layouts, slice_shapes, temp_dir):
+    """Extract the ZeRO fragments, merging every parameter as soon as all of its fragments are extracted."""
     _3d_range_list = list(
         itertools.product(range(ds_checkpoint.pp_degree), range(ds_checkpoint.tp_degree),
                           range(ds_checkpoint.dp_degree)))
     # pprint(f'{_3d_range_list=}')
-    work_chunks = list(_get_chunks(_3d_range_list, args.num_extract_workers))
-    # pprint(f'{work_chunks=}')
-
-    # extract_zero_shards(temp_dir, ds_checkpoint, _3d_range_list[0])
-    do_work = partial(extract_zero_shards, temp_dir, ds_checkpoint)
-    _do_parallel_work(do_work, work_chunks, args.num_extract_workers)
 
-
-def _merge_tp_slice_files(args, ds_checkpoint, slice_shapes, temp_dir):
-    work_chunks = list(_get_chunks(list(slice_shapes.items()), args.num_merge_workers))
-    #pprint(work_chunks)
-    zero_output_folder = os.path.join(args.output_folder, "zero")
-    do_work = partial(merge_tp_slices, ds_checkpoint, zero_output_folder, temp_dir, ds_checkpoint.tp_degree)
-    _do_parallel_work(do_work, work_chunks, args.num_merge_workers)
+    moment_dtype = MOMENT_DTYPES[args.moment_dtype]
+    extract_state = _get_worker_state(ds_checkpoint,
+                                      param_layouts=param_layouts,
+                                      temp_dir=temp_dir,
+                                      moment_dtype=moment_dtype)
+    merge_state = _get_worker_state(ds_checkpoint,
+                                    output_dir=os.path.join(args.output_folder, "zero"),
+                                    temp_dir=temp_dir,
+                                    strict_replica_check=args.strict_replica_check,
+                                    moment_dtype=moment_dtype)
+    extract_pool = _create_pool(args.num_extract_workers, extract_state)
+    merge_pool = _create_pool(args.num_merge_workers, merge_state)
+
+    # a parameter is ready to merge once its extracted fragments cover all of its tp slices
+    pending_numel = {name: ds_checkpoint.tp_degree * torch.Size(shape).numel() for name, shape in slice_shapes.items()}
+    merge_results = []
+
+    # a single pass over the whole work list keeps all workers busy instead of
+    # draining the pool after every batch of num_workers items
+    chunksize = max(1, len(_3d_range_list) // (4 * args.num_extract_workers))
+    extracted = extract_pool.imap_unordered(extract_zero_shards, _3d_range_list, chunksize=chunksize)
+    for fragments in tqdm.tqdm(extracted, total=len(_3d_range_list)):
+        ready = []
+        for name, numel in fragments:
+            pending_numel[name] -= numel
+            if pending_numel[name] == 0:
+                ready.append(name)
+        # of the parameters completed together, merge the largest first so they don't end up as the stragglers
+        ready.sort(key=lambda name: torch.Size(slice_shapes[name]).numel(), reverse=True)
+        for name in ready:
+            merge_results.append(merge_pool.apply_async(merge_tp_slices, ((name, slice_shapes[name]), )))
+    extract_pool.close()
+    extract_pool.join()
+
+    incomplete = [name for name, numel in pending_numel.items() if numel != 0]
+    assert not incomplete, f'Extracted ZeRO fragments do not cover parameters {incomplete}'
+
+    for result in tqdm.tqdm(merge_results):
+        result.get()
+    merge_pool.close()
+    merge_pool.join()
 
 
 def _save_optimizer_state(args, ds_checkpoint):
@@ -266,29 +539,40 @@ def main():
                                                 ds_checkpoint.pp_degree)
 
     slice_shapes = []
-    for mp_rank_file in ds_checkpoint.mp_rank_files:
-        mp_sd = torch.load(mp_rank_file, map_location=torch.device('cpu'))
-        slice_shapes += mp_sd[PARAM_SHAPES]
+    param_layouts = {}
+    for pp_index in range(ds_checkpoint.pp_degree):
+        for tp_index in range(ds_checkpoint.tp_degree):
+            for mp_rank_file in ds_checkpoint.get_2d_parallel_files(tp_index=tp_index, pp_index=pp_index):
+                mp_sd = _load_model_states(mp_rank_file)
+                slice_shapes += mp_sd[PARAM_SHAPES]
+                # layout of the flattened groups is the same for all tp ranks of a pp stage
+                if pp_index not in param_layouts:
+                    param_layouts[pp_index] = _get_param_layout(mp_sd[PARAM_SHAPES])
+                del mp_sd
 
     # fix back to normal flat dict, merge duplicates for tp>1
     slice_shapes = dict((k, v) for d in slice_shapes for k, v in d.items())
-    temp_dir = os.path.join(args.output_folder, 'tmp')
-
-    print('*** 1. Extracting ZeRO fragments')
-    _extract_zero_shard_files(args, ds_checkpoint, temp_dir)
-
-    print('*** 2. Merging slices')
-    _merge_tp_slice_files(args, ds_checkpoint, slice_shapes, temp_dir)
-
-    print('*** 3. Saving common optimizer states')
-    _save_optimizer_state(args, ds_checkpoint)
-
-    if not args.keep_temp_folder:
-        shutil.rmtree(temp_dir, ignore_errors=True)
+    temp_dir = _get_temp_folder(args, slice_shapes, ds_checkpoint.tp_degree)
+    _create_temp_folder(temp_dir)
+    print(f'Extracting ZeRO fragments to {temp_dir}')
+
+    # the temp folder may be in shared memory, so it must not outlive a failed conversion either
+    try:
+        print('*** 1. Extracting ZeRO fragments and merging slices')
+        _convert_zero_shard_files(args, ds_checkpoint, param_layouts, slice_shapes, temp_dir)
+
+        print('*** 2. Saving common optimizer states')
+        _save_optimizer_state(args, ds_checkpoint)
+    finally:
+        if args.keep_temp_folder:
+            print(f'Keeping extracted ZeRO fragments in {temp_dir}')
+        else:
+            shutil.rmtree(temp_dir, ignore_errors=True)
 
     # Copy mp* files into output folder
-    for f in glob.glob(os.path.join(args.input_folder, 'mp*')):
-        shutil.copy2(f, args.output_folder)
+    for entry in os.scandir(args.input_folder):
+        if entry.name.startswith('mp'):
+            shutil.copy2(entry.path, args.output_folder)
 
     # Update latest to output folder
     checkpoint_root_folder, step_folder = os.path.split(args.output_folder)
@@ -4,6 +4,8 @@
 # DeepSpeed Team
 
 # Automatic Tensor Parallelism
+import bisect
+import functools
 import re
 
 from torch import nn
@@ -13,9 +15,69 @@ import torch
 from deepspeed import comm as dist
 from .layers import LinearAllreduce, LinearLayer, LmHeadLinearAllreduce
 from deepspeed.accelerator import get_accelerator
-from .fusedqkv_utils import require_tp_fused_qkvw, prepare_tp_fused_qkvw
+from .fusedqkv_utils import require_tp_fused_qkvw, prepare_tp_fused_qkvw_pair
 from deepspeed.module_inject.tp_shard import get_shard_size, get_shard_size_list
 
+# names of linear layers whose output is all-reduced
+GEM_LAYER_NAMES = {'out_proj', 'o_proj', 'down_proj'}
+
+
+@functools.lru_cache(maxsize=None)
+def _get_policy_layer_classes():
+    policy = []
+    for plcy in replace_policies:
+        # instantiate a throw-away policy in order to populate the _orig_layer_class
+        _ = plcy(None)
+        if isinstance(plcy._orig_layer_class, list):
+            for orig_layer_class in plcy._orig_layer_class:
+                policy.append(orig_layer_class)
+        elif plcy._orig_layer_class is not None:
+            policy.append(plcy._orig_layer_class)
+    return frozenset(policy)
+
+
+# attributes holding sizes that have to be sharded along with the layers of a module
+MP_PARAM_NAMES = ("n_heads", "inner_dim", "num_heads", "num_kv", "num_attention_heads", "num_attn_heads",
+                  "all_head_size", "embed_dim", "hidden_size", "num_key_value_heads")
+
+
+@functools.lru_cache(maxsize=None)
+def _get_class_mp_params(module_class):
+    return frozenset(param for param in MP_PARAM_NAMES if hasattr(module_class, param))
+
+
+# model families AutoTP cannot shard, keyed like supported() derives them from the model's class names
+UNSUPPORTED_MODELS = frozenset(['deberta', 'flaubert', 'fsmt', 'gpt2', 'led', 'longformer', 'xlm', 'xlnet'])
+MODEL_KEY_PATTERN = re.compile(r"(.*?)Model")
+STACK_KEY_PATTERN = re.compile(r"(.*?)Stack")
+
+
+@functools.lru_cache(maxsize=None)
+def _get_copy_stream(device_name):
+    # a single side stream per device for the host to device copies of all AutoTP instances, one is built per block
+    return get_accelerator().Stream(device=device_name)
+
+
+def _match_module_names(pattern, module_names):
+    for module_name in module_names:
+        key = pattern.match(module_name)
+        if key is not None:
+            return key
+    return None
+
+
+class IndexedStateDict(dict):
+    """A state_dict that also keeps its keys sorted, so that modules can be looked up in it by key prefix with a
+    binary search. The index is built once per checkpoint and shared by the AutoTP instances of all blocks."""
+
+    def __init__(self, state_dict):
+        super().__init__(state_dict)
+        self.sorted_keys = sorted(self.keys())
+
+    def has_prefix(self, prefix):
+        i = bisect.bisect_left(self.sorted_keys, prefix)
+        return i < len(self.sorted_keys) and self.sorted_keys[i].startswith(prefix)
+
 
 class ReplaceWithTensorSlicing:
 
@@ -34,6 +96,21 @@ class ReplaceWithTensorSlicing:
             for merging your checkpoints before replacing the transformer layer with\
             inference-kernels'
 
+    def _materialize(self, dst):
+        # meta tensors cannot be copied to, so they are replaced by a real tensor right before a shard of src is
+        # written to them; a meta dst of the same shape as src takes src as is and is never materialized, so full
+        # weights stay on the host until AutoTP shards them
+        if dst.data.is_meta:
+            return torch.empty_like(dst.data, device=get_accelerator().current_device_name())
+        return dst
+
+    def _select_qkv_shard(self, src, dim, num_splits, qkv_size):
+        # view dim as [num_splits, num_shards, qkv_size] and pick this rank's shard of each split; the strided
+        # result is only materialized by the copy into dst
+        dim = dim % src.dim()
+        return src.unflatten(dim, (num_splits, -1, qkv_size)).select(dim + 1, self.gpu_index).flatten(dim, dim + 1)
+
+    @torch.no_grad()
     def strided_copy(self,
                      dst: Optional[torch.Tensor],
                      src: Optional[torch.Tensor],
@@ -50,43 +127,37 @@ class ReplaceWithTensorSlicing:
         if allocate_tensor:
             dst = torch.empty_like(dst)
 
-        src_split = torch.split(src.data, src.shape[outer_dim] // num_splits, dim=outer_dim)
         if (len(src_shape) == 2 and len(dst_shape) == 2):
             if src_shape[outer_dim] == dst_shape[self.out_dim]:
-                try:
-                    dst = dst.reshape(-1).data.copy_(src.data.reshape(-1)).reshape(src.shape)
-                except:
-                    print(dst.shape, src.shape)
-                    exit()
+                assert dst.numel() == src.numel(), f"Cannot copy a tensor of shape {src_shape} into {dst_shape}"
+                if dst.data.is_meta:
+                    dst = src.data.to(dst.dtype)
+                else:
+                    dst = dst.reshape(src_shape).data.copy_(src.data)
                 dst = torch.nn.parameter.Parameter(dst, requires_grad=False)
                 if hasattr(src, 'scale'):
                     dst.scale = src.scale
                 return dst
             self.merge_assert(src_shape[outer_dim], dst_shape[self.out_dim])
             qkv_size = dst_shape[self.out_dim] // num_splits
-            qkv_split = [torch.split(src_s, qkv_size, dim=outer_dim) for src_s in src_split]
-            weight_split = [
-                torch.cat([qkv_s[i] for qkv_s in qkv_split], axis=outer_dim) for i in range(len(qkv_split[0]))
-            ]
-            dst = dst.reshape(-1).data.copy_(weight_split[self.gpu_index].contiguous().reshape(-1)).reshape(
-                weight_split[self.gpu_index].shape)
+            weight_shard = self._select_qkv_shard(src.data, outer_dim, num_splits, qkv_size)
+            dst = self._materialize(dst).reshape(weight_shard.shape).data.copy_(weight_shard)
         else:
             if src_shape[0] == dst_shape[0]:
                 return torch.nn.parameter.Parameter(src)
             qkv_size = dst_shape[0] // num_splits
-            qkv_split = [torch.split(src_s, qkv_size, dim=0) for src_s in src_split]
-            bias_split = [torch.cat([qkv_s[i] for qkv_s in qkv_split], axis=0) for i in range(len(qkv_split[0]))]
-            dst.data.copy_(bias_split[self.gpu_index].contiguous())
+            dst = self._materialize(dst)
+            dst.data.copy_(self._select_qkv_shard(src.data, 0, num_splits, qkv_size))
 
         dst = torch.nn.parameter.Parameter(dst, requires_grad=False)
         if hasattr(src, 'scale'):
             dst.scale = src.scale
         return dst
 
+    @torch.no_grad()
     def copy(self, dst, src, int8=False, allocate_tensor=False):
         if src is None:
             return src
-        assert not dst.data.is_meta  # the torch.Tensor.copy_ method used below will silently fail on meta tensors
         if allocate_tensor:
             dst = torch.empty_like(dst)
         outer_dim = 0 if int8 else 1
@@ -94,23 +165,29 @@ class ReplaceWithTensorSlicing:
         src_shape = src.shape
         dst_shape = dst.shape
         if (len(src_shape) == 2 and len(dst_shape) == 2):
-
             if src_shape[inner_dim] == dst_shape[self.in_dim] and src_shape[outer_dim] == dst_shape[self.out_dim]:
-                dst = dst.reshape(-1).data.copy_(src.data.reshape(-1)).reshape(src.shape)
+                if dst.data.is_meta:
+                    dst = src.data.to(dst.dtype)
+                else:
+                    dst = dst.reshape(src_shape).data.copy_(src.data)
             else:
+                dst = self._materialize(dst)
                 if src_shape[inner_dim] != dst_shape[self.in_dim]:
                     self.merge_assert(src_shape[inner_dim], dst_shape[self.in_dim])
-                    dst.data.copy_(src[:, self.gpu_index * dst_shape[self.in_dim]: (self.gpu_index + 1) * dst_shape[self.in_dim]] if inner_dim == 1 else \
-                                   src[self.gpu_index * dst_shape[self.in_dim]: (self.gpu_index + 1) * dst_shape[self.in_dim], :])
+                    dst.data.copy_(
+                        src.narrow(inner_dim, self.gpu_index * dst_shape[self.in_dim], dst_shape[self.in_dim]))
                 else:
                     self.merge_assert(src_shape[outer_dim], dst_shape[self.out_dim])
-                    dst.data.copy_(src[:, self.gpu_index * dst_shape[self.out_dim]: (self.gpu_index + 1) * dst_shape[self.out_dim]] if outer_dim == 1 else \
-                                   src[self.gpu_index * dst_shape[self.out_dim]: (self.gpu_index + 1) * dst_shape[self.out_dim], :])
+                    dst.data.copy_(
+                        src.narrow(outer_dim, self.gpu_index * dst_shape[self.out_dim], dst_shape[self.out_dim]))
         else:
-            if src_shape[0] == dst_shape[0]:
-                dst = src if src.dtype == dst.dtype else dst.data.copy_(src)
+            if src_shape[0] == dst_shape[0] and src.dtype == dst.dtype:
+                dst = src
+            elif src_shape[0] == dst_shape[0]:
+                dst = src.to(dst.dtype) if dst.data.is_meta else dst.data.copy_(src)
             else:
-                dst.data.copy_(src[self.gpu_index * dst_shape[-1]:(self.gpu_index + 1) * dst_shape[-1]])
+                dst = self._materialize(dst)
+                dst.data.copy_(src.narrow(0, self.gpu_index * dst_shape[-1], dst_shape[-1]))
         dst = torch.nn.parameter.Parameter(dst, requires_grad=False)
         if hasattr(src, 'scale'):
             dst.scale = src.scale
@@ -124,22 +201,36 @@ class Loading():
         load_layer_names = ["LPLayerNorm", "SharedEmbedding", "OPTLearnedPositionalEmbedding", "LlamaRMSNorm"]
         return module.__class__ in load_layers or module._get_name() in load_layer_names
 
+    @torch.no_grad()
     def load_buffer(module, state_dict, prefix):
+        # meta tensors are materialized directly on the accelerator rather than on the host and copied over later
+        device = get_accelerator().current_device_name()
+        buffers = []
+        values = []
         for name in module._buffers.keys():
             if module._buffers[name].data.is_meta:
                 module._buffers[name] = torch.nn.parameter.Parameter(
-                    data=torch.empty_like(module._buffers[name].data, device="cpu"),
+                    data=torch.empty_like(module._buffers[name].data, device=device),
                     requires_grad=module._buffers[name].data.requires_grad)
             if prefix + name in state_dict.keys():
-                module._buffers[name].data.copy_(state_dict[prefix + name])
+                buffers.append(module._buffers[name].data)
+                values.append(state_dict[prefix + name])
+        if not buffers:
+            return
+        # copy all buffers of the module with a single foreach call instead of dispatching a copy per buffer
+        if hasattr(torch, '_foreach_copy_'):
+            torch._foreach_copy_(buffers, values)
+        else:
+            for buffer, value in zip(buffers, values):
+                buffer.copy_(value)
 
+    @torch.no_grad()
     def load(module, state_dict, prefix, mp_group=None):
+        # meta tensors are passed on as they are: ReplaceWithTensorSlicing takes state_dict values of the same shape
+        # as they are and only materializes a meta tensor on the accelerator to write a shard into it
         mp_replace = ReplaceWithTensorSlicing(mp_group=mp_group)
         if hasattr(module, 'weight'):
             if module.weight.data.is_meta:
-                # meta tensor cannot be casted or copied to, so we need to replace it with a normal tensor here
-                module.weight = torch.nn.parameter.Parameter(data=torch.empty_like(module.weight.data, device="cpu"),
-                                                             requires_grad=module.weight.data.requires_grad)
                 if 'query_key_value' in prefix:
                     module.weight = mp_replace.strided_copy(module.weight.data,
                                                             state_dict[prefix + 'weight'],
@@ -148,27 +239,13 @@ class Loading():
                     module.weight = mp_replace.copy(module.weight.data, state_dict[prefix + 'weight'])
         else:
             if hasattr(module, 'norm') and hasattr(module.norm, 'weight'):
-                if module.norm.weight.data.is_meta:
-                    # meta tensor cannot be casted or copied to, so we need to replace it with a normal tensor here
-                    module.norm.weight = torch.nn.parameter.Parameter(
-                        data=torch.empty_like(module.norm.weight.data, device="cpu"),
-                        requires_grad=module.norm.weight.data.requires_grad)
                 module.norm.weight = mp_replace.copy(module.norm.weight.data, state_dict[prefix + 'weight'])
 
         if prefix + 'bias' in state_dict.keys():
             if hasattr(module, 'bias'):
-                if module.bias.data.is_meta:
-                    # meta tensor cannot be casted or copied to, so we need to replace it with a normal tensor here
-                    module.bias = torch.nn.parameter.Parameter(data=torch.empty_like(module.bias.data, device="cpu"),
-                                                               requires_grad=module.bias.data.requires_grad)
                 module.bias = mp_replace.copy(module.bias, state_dict[prefix + 'bias'])
             else:
                 if hasattr(module, 'norm') and hasattr(module.norm, 'bias'):
-                    if module.norm.bias.data.is_meta:
-                        # meta tensor cannot be casted or copied to, so we need to replace it with a normal tensor here
-                        module.norm.bias = torch.nn.parameter.Parameter(
-                            data=torch.empty_like(module.norm.bias.data, device="cpu"),
-                            requires_grad=module.norm.bias.data.requires_grad)
                     module.norm.bias = mp_replace.copy(module.norm.bias, state_dict[prefix + 'bias'])
 
 
@@ -186,114 +263,100 @@ class AutoTP():
         self.orig_layer_impl = orig_layer_impl
         self.linear_policies = None
         self.conv_linear_layer = False
+        # side stream the host to device copies of the shards were issued on, if any
+        self.copy_stream = None
 
-    def in_module_list(module, module_list):
-        for item in module_list:
-            if type(item).__name__ == type(module).__name__:
-                return True
-        return False
+    def _has_state_dict_prefix(self, prefix):
+        if isinstance(self.state_dict, IndexedStateDict):
+            return self.state_dict.has_prefix(prefix)
+        return any(key.startswith(prefix) for key in self.state_dict)
 
     def get_module_list(model):
+        # first module of each type held by the ModuleLists of a subtree; modules of the same type found in
+        # different subtrees, such as encoder and decoder blocks, are all kept since their layers can differ
         mlist = []
+        module_types = set()
         for child in model.children():
             if isinstance(child, nn.ModuleList):
                 for module in child.children():
-                    if not mlist:
-                        mlist = [module]
-                    elif not AutoTP.in_module_list(module, mlist):
-                        mlist = mlist + [module]
+                    if type(module).__name__ not in module_types:
+                        module_types.add(type(module).__name__)
+                        mlist.append(module)
             else:
-                mlist = mlist + AutoTP.get_module_list(child)
+                submodules = AutoTP.get_module_list(child)
+                module_types.update(type(module).__name__ for module in submodules)
+                mlist.extend(submodules)
         return mlist
 
     def supported(model):
-        unsupported = ['deberta', 'flaubert', 'fsmt', 'gpt2', 'led', 'longformer', 'xlm', 'xlnet']
-        model = str(model)
-        key = re.search(r": (.*?)Model", model)
+        # look the key up in the class names of the submodules, in the order str(model) would list them, instead
+        # of building the representation of the whole model
+        module_names = [module._get_name() for module in model.modules()]
+        key = _match_module_names(MODEL_KEY_PATTERN, module_names[1:])
         if key is None:
-            key = re.search(r": (.*?)Stack", model)
+            key = _match_module_names(STACK_KEY_PATTERN, module_names[1:])
         if key is None:
-            key = re.match(r"(.*?)Model", model)
+            key = MODEL_KEY_PATTERN.match(module_names[0])
         assert key is not None, "Not able to determine model policy automatically. Please provide policy."
-        if key.group(1).lower() in unsupported:
+        if key.group(1).lower() in UNSUPPORTED_MODELS:
             return False
         return True
 
     def get_layers(parent, module):
+        # linear layers are named after their immediate parent only ("<parent>.<name>"), as _replace_module names
+        # them; a depth-first walk over an explicit stack keeps the order of the original recursion
         layer_list = []
-        for key, submodule in module._modules.items():
+        stack = [(parent, key, submodule) for key, submodule in reversed(module._modules.items())]
+        while stack:
+            parent, key, submodule = stack.pop()
             if isinstance(submodule, nn.Linear):
-                layer_list = layer_list + [parent + "." + key]
+                layer_list.append(parent + "." + key)
             elif isinstance(submodule, nn.LayerNorm) or key == 'LayerNorm' or key == 'layer_norm':
-                layer_list = layer_list + ["ln"]
+                layer_list.append("ln")
             else:
-                layer_list = layer_list + AutoTP.get_layers(key, submodule)
+                stack.extend((key, child_key, child) for child_key, child in reversed(submodule._modules.items()))
         return layer_list
 
-    def update_policy_list(policy_list, new_module, new_gems):
-        if len(policy_list):
-            for i, policy in enumerate(policy_list):
-                # if module already exists in policy, combine gems and remove duplicates
-                if policy[0] == type(new_module):
-                    new_gems = set(new_gems + policy[1])
-                    policy_list[i] = tuple([type(new_module), new_gems])
-                    return policy_list
-        policy_list.append(tuple([type(new_module), new_gems]))
-        return policy_list
-
     def kernel_supported(module_list):
-        policy = []
-        for plcy in replace_policies:
-            # instantiate a throw-away policy in order to populate the _orig_layer_class
-            _ = plcy(None)
-            if isinstance(plcy._orig_layer_class, list):
-                for orig_layer_class in plcy._orig_layer_class:
-                    policy.append(orig_layer_class)
-            elif plcy._orig_layer_class is not None:
-                policy.append(plcy._orig_layer_class)
+        policy = _get_policy_layer_classes()
         for child in module_list:
             if child.__class__ in policy:
                 return True
         return False
 
     def tp_parser(model):
-        policy_list = []
+        # gems of every module type, combined across modules of the same type and kept in the order they are found
+        policy_dict = {}
         module_list = []
-        layer_list = []
         gem_list = []
 
         module_list = AutoTP.get_module_list(model)
         assert AutoTP.supported(model), "AutoTP not supported for model. Please use kernel injection since container policy for model exists." \
         if AutoTP.kernel_supported(module_list) else "AutoTP not supported for model. Please provide policy."
+        # str() of a module walks its whole subtree, so the model's is only built if needed, and only once
+        model_str = None
         for module in module_list:
-            for key, submodule in module._modules.items():
-                if isinstance(submodule, nn.Linear):
-                    layer_list = layer_list + ["." + key]
-                elif isinstance(submodule, nn.LayerNorm) or key == 'LayerNorm' or key == 'layer_norm':
-                    layer_list = layer_list + ["ln"]
-                else:
-                    layer_list = layer_list + AutoTP.get_layers(key, submodule)
+            module_type_str = str(type(module))
+            layer_list = AutoTP.get_layers("", module)
             for i, layer in enumerate(layer_list):
                 if layer == 'ln':
                     if layer_list[i - 1] != 'ln':
-                        gem_list = gem_list + [layer_list[i - 1]]
-                elif 'out_proj' in layer:
-                    gem_list = gem_list + [layer]
-                elif 'o_proj' in layer:
-                    gem_list = gem_list + [layer]
-                elif 'down_proj' in layer:
-                    gem_list = gem_list + [layer]
-                elif 'attention.dense' in layer and 'GPTNeoX' in str(model):
-                    gem_list = gem_list + [layer]
-                elif 'self_attention.dense' in layer and 'falcon' in str(
-                        type(module)):  # this is a hack to get the right linear layer for this model!
-                    gem_list = gem_list + [layer]
-
-            layer_list = []
+                        gem_list.append(layer_list[i - 1])
+                elif layer.rsplit('.', 1)[-1] in GEM_LAYER_NAMES:
+                    gem_list.append(layer)
+                elif 'attention.dense' in layer:
+                    if model_str is None:
+                        model_str = str(model)
+                    if 'GPTNeoX' in model_str:
+                        gem_list.append(layer)
+                    elif 'self_attention.dense' in layer and 'falcon' in module_type_str:
+                        # this is a hack to get the right linear layer for this model!
+                        gem_list.append(layer)
+
             if gem_list != []:
-                gem_list = list(set(gem_list))
-                policy_list = AutoTP.update_policy_list(policy_list, module, gem_list)
+                policy_dict.setdefault(type(module), {}).update(dict.fromkeys(gem_list))
                 gem_list = []
+        policy_list = [tuple([module_type, list(gems)]) for module_type, gems in policy_dict.items()]
         assert len(policy_list), "AutoTP not supported for model. Please use kernel injection since container policy for model exists." \
         if AutoTP.kernel_supported(module_list) else "Not able to determine model policy automatically. Please provide policy."
         return policy_list
@@ -302,10 +365,31 @@ class AutoTP():
         self.mp_size = mp_size
         self.mp_group = mp_group
 
+    def _get_shard(self, tensor, dim, gpu_index, total_size=None):
+        # narrow to this rank's shard and copy only that to the device, rather than splitting the whole tensor
+        # and cloning the shard once it is there
+        shard_sizes = get_shard_size_list(tensor.shape[dim] if total_size is None else total_size, self.mp_size)
+        offset = sum(shard_sizes[:gpu_index])
+        shard = tensor.narrow(dim, offset, shard_sizes[gpu_index])
+        if get_accelerator().Stream is None or shard.device.type != 'cpu':
+            return shard.to(get_accelerator().current_device_name(), non_blocking=True, copy=True)
+        self.copy_stream = _get_copy_stream(get_accelerator().current_device_name())
+
+        # stage host shards in pinned memory and copy them on the side stream, so that the transfer overlaps with
+        # slicing the following layers; wait_for_copies() orders the copies before any use on the current stream
+        shard = get_accelerator().pin_memory(shard)
+        with get_accelerator().stream(self.copy_stream):
+            shard = shard.to(get_accelerator().current_device_name(), non_blocking=True)
+        shard.record_stream(get_accelerator().current_stream())
+        return shard
+
+    def wait_for_copies(self):
+        if self.copy_stream is not None:
+            get_accelerator().current_stream().wait_stream(self.copy_stream)
+
     def _replace(self, child, name, conv_linear_layer):
         if getattr(child, "replaced", False) == True:
             return
-        weight_shape = child.weight.shape
         mp_replace = ReplaceWithTensorSlicing(mp_group=self.mp_group)
         if name in self.all_reduce_linears:
             # if conv_linear_layer [weight_shape[1], weight_shape[0] // mp_size]
@@ -313,11 +397,7 @@ class AutoTP():
 
             if self.conv_linear_layer:
                 child.weight.data = child.weight.data.transpose(-1, -2).contiguous()
-            data = child.weight.data.split(get_shard_size_list(
-                weight_shape[0] if self.conv_linear_layer else weight_shape[1], self.mp_size),
-                                           dim=1)
-            data_dc = data[mp_replace.gpu_index].to(get_accelerator().current_device_name()).clone().detach()
-            del data
+            data_dc = self._get_shard(child.weight.data, 1, mp_replace.gpu_index)
 
             setattr(child, "replaced", True)
             if name == "lm_head" or name == 'embed_out':
@@ -338,24 +418,17 @@ class AutoTP():
                 #for detecting fused type
                 module_str = str(self.module).strip()
                 #The copy is a regular copy, The shape of dst and src is the same
-                data_dc = prepare_tp_fused_qkvw(module_str, child.weight.data, self.mp_size, mp_replace.gpu_index)
-
-                bias_data_dc = None if child.bias is None else prepare_tp_fused_qkvw(
-                    module_str, child.bias.data, self.mp_size, mp_replace.gpu_index).to(
-                        get_accelerator().current_device_name())
+                data_dc, bias_data_dc = prepare_tp_fused_qkvw_pair(module_str, child.weight.data,
+                                                                   None if child.bias is None else child.bias.data,
+                                                                   self.mp_size, mp_replace.gpu_index)
+                if bias_data_dc is not None:
+                    bias_data_dc = bias_data_dc.to(get_accelerator().current_device_name())
             else:
-                data = child.weight.data.split(get_shard_size_list(weight_shape[0], self.mp_size),
-                                               dim=1 if self.conv_linear_layer else 0)
-                data_dc = data[mp_replace.gpu_index].to(get_accelerator().current_device_name()).clone().detach()
-                del data
+                data_dc = self._get_shard(child.weight.data, 1 if self.conv_linear_layer else 0, mp_replace.gpu_index)
 
                 if child.bias is not None:
-                    bias_data = child.bias.data.split(get_shard_size_list(
-                        weight_shape[1] if self.conv_linear_layer else weight_shape[0], self.mp_size),
-                                                      dim=0)
-                    bias_data = bias_data[mp_replace.gpu_index].to(get_accelerator().current_device_name())
+                    bias_data = self._get_shard(child.bias.data, 0, mp_replace.gpu_index)
                     bias_data_dc = torch.nn.parameter.Parameter(bias_data, requires_grad=False)
-                    del bias_data
                 else:
                     bias_data_dc = None
 
@@ -368,26 +441,24 @@ class AutoTP():
             return
         mp_replace = ReplaceWithTensorSlicing(mp_group=self.mp_group)
 
-        if hasattr(child.weight, 'ds_tensor'):
-            data = child.weight.ds_tensor.data.split(get_shard_size_list(child.weight.shape[1], self.mp_size), dim=1)
-        else:
-            data = child.weight.data.split(get_shard_size_list(child.weight.shape[1], self.mp_size), dim=1)
-        data = data[mp_replace.gpu_index].to(get_accelerator().current_device_name())
-        data = torch.nn.parameter.Parameter(data, requires_grad=False)
+        weight = child.weight.ds_tensor.data if hasattr(child.weight, 'ds_tensor') else child.weight.data
+        data = self._get_shard(weight, 1, mp_replace.gpu_index, total_size=child.weight.shape[1])
 
-        new_embedding = nn.Embedding(child.weight.shape[0], get_shard_size(child.weight.shape[1], self.mp_size))
-        new_embedding.weight.data.copy_(data)
+        # the shard becomes the embedding's weight as is, instead of initializing a new weight and copying into it
+        new_embedding = nn.Embedding(child.weight.shape[0],
+                                     get_shard_size(child.weight.shape[1], self.mp_size),
+                                     _weight=data)
         setattr(child, "replaced", True)
         return new_embedding
 
     def update_mp_params(self, child):
         if getattr(child, "replaced", False) == True:
             return
-        for param in [
-                "n_heads", "inner_dim", "num_heads", "num_kv", "num_attention_heads", "num_attn_heads",
-                "all_head_size", "embed_dim", "hidden_size", "num_key_value_heads"
-        ]:
-            if hasattr(child, param):
+        # plain attributes of a module live in its __dict__, anything else is defined by its class; this avoids
+        # probing every name through nn.Module.__getattr__ on every child
+        class_params = _get_class_mp_params(type(child))
+        for param in MP_PARAM_NAMES:
+            if param in child.__dict__ or param in class_params:
                 param_val = getattr(child, param)
                 setattr(child, param, get_shard_size(param_val, self.mp_size))
         setattr(child, "replaced", True)
@@ -409,6 +480,7 @@ class AutoTP():
             else:
                 self.linear_policies = {nn.Linear: self._replace, nn.Embedding: self._slice_embedding}
 
+    @torch.no_grad()
     def _replace_module(self, r_module, prev_name='', prev_class_name=''):
         for name, child in r_module.named_children():
             if prev_class_name == "":
@@ -419,24 +491,15 @@ class AutoTP():
                 class_name = prev_class_name + '.' + prev_name
             checking_key = self.prefix + '.' + class_name + '.' + name + '.' if class_name != "" else self.prefix + '.' + name + '.'
             if Loading.is_load_module(child) and self.state_dict is not None:
-                if any(checking_key in item for item in self.state_dict):
+                if self._has_state_dict_prefix(checking_key):
                     Loading.load(child, self.state_dict, checking_key, self.mp_group)
                 else:
                     continue
             if len(child._buffers) != 0 and self.state_dict is not None:
                 Loading.load_buffer(child, self.state_dict, checking_key)
-            if child.__class__ in self.linear_policies:
-                setattr(r_module, name, self.linear_policies[child.__class__](child, prev_name + '.' + name,
-                                                                              self.conv_linear_layer))
-            elif any(isinstance(child, lp) for lp in self.linear_policies):
-                # Added for falcon model support
-                # Note: isinstance will account for class inheritance, child.__class__ does not
-                key = None
-                for lp in self.linear_policies:
-                    if isinstance(child, lp):
-                        key = lp
-                        break
-                assert key is not None
+            # walk the MRO so that subclasses of a policy's layer class (e.g. falcon's linear) are replaced too
+            key = next((base for base in child.__class__.__mro__ if base in self.linear_policies), None)
+            if key is not None:
                 setattr(r_module, name, self.linear_policies[key](child, prev_name + '.' + name,
                                                                   self.conv_linear_layer))
             else:
@@ -454,6 +517,7 @@ class AutoTP():
                     break
         return num_kv_heads
 
+    @torch.no_grad()
     def _replace_last_linear_module(self, r_module):
         if hasattr(r_module, "lm_head"):
             name = "lm_head"
@@ -27,9 +27,7 @@ def require_tp_fused_qkvw(name, mp_size):
     return False
 
 
-def prepare_tp_fused_qkvw(module_str, src, mp_size, gpu_index):
-    if src == None:
-        return
+def get_fused_qkv_type(module_str):
     fused_type_dict = {
         'CodeGenBlock': 'codegentype',
         'BloomBlock': 'bloomtype',
@@ -38,6 +36,18 @@ def prepare_tp_fused_qkvw(module_str, src, mp_size, gpu_index):
         "MptBlock": 'glmtype',
     }
 
+    for module_name, fused_type in fused_type_dict.items():
+        if re.search(module_name, module_str):
+            return fused_type
+    warning_once(f"Unrecognized fusedkqv weight type, default to using bloom type,"
+                 f"please check in prepare_tp_fused_qkvw() to avoid potential calculation errors")
+    return 'bloomtype'
+
+
+def prepare_tp_fused_qkvw(module_str, src, mp_size, gpu_index, fused_qkv_type=None):
+    if src == None:
+        return
+
     def _codegen_type_transpose(input, mp_size, codegen_mp_num=4):
         # codegen_mp_num defined in https://github.com/huggingface/transformers/blob/main/src/transformers/models/codegen/modeling_codegen.py
         assert get_num_kv_heads() % (
@@ -88,9 +98,13 @@ def prepare_tp_fused_qkvw(module_str, src, mp_size, gpu_index):
 
         raise ValueError("unknown fused_qkv_type")
 
-    for module_name, fused_type in fused_type_dict.items():
-        if re.search(module_name, module_str):
-            return _transpose_fused_qkvw(src, mp_size, fused_type)
-    warning_once(f"Unrecognized fusedkqv weight type, default to using bloom type,"
-                 f"please check in prepare_tp_fused_qkvw() to avoid potential calculation errors")
-    return _bloom_type_transpose(src, mp_size)
+    if fused_qkv_type is None:
+        fused_qkv_type = get_fused_qkv_type(module_str)
+    return _transpose_fused_qkvw(src, mp_size, fused_qkv_type)
+
+
+def prepare_tp_fused_qkvw_pair(module_str, weight, bias, mp_size, gpu_index):
+    # the fused layout is detected once and used for both the weight and the bias
+    fused_qkv_type = get_fused_qkv_type(module_str)
+    return (prepare_tp_fused_qkvw(module_str, weight, mp_size, gpu_index, fused_qkv_type),
+            prepare_tp_fused_qkvw(module_str, bias, mp_size, gpu_index, fused_qkv_type))
@@ -13,7 +13,7 @@ from deepspeed.ops.transformer.inference.diffusers_transformer_block import Deep
 from deepspeed.ops.transformer.inference.diffusers_2d_transformer import Diffusers2DTransformerConfig
 from deepspeed.accelerator import get_accelerator
 from .replace_policy import replace_policies, generic_policies
-from .auto_tp import AutoTP, ReplaceWithTensorSlicing, Loading
+from .auto_tp import AutoTP, ReplaceWithTensorSlicing, Loading, IndexedStateDict
 
 from deepspeed import comm as dist
 from deepspeed.module_inject.tp_shard import set_num_kv_heads
@@ -283,8 +283,13 @@ def replace_transformer_layer(orig_layer_impl, model, checkpoint_dict, config, m
 
         # 6. Replace modules
         if "lm_head" in all_reduce_linears or "embed_out" in all_reduce_linears:
-            return _autotp._replace_last_linear_module(module)
-        return _autotp._replace_module(module)
+            module = _autotp._replace_last_linear_module(module)
+        else:
+            module = _autotp._replace_module(module)
+
+        # 7. Order the asynchronous shard copies before any use of the replaced modules
+        _autotp.wait_for_copies()
+        return module
 
     def replace_fn(child, _policy, layer_id=0, prefix="", state_dict=None):
         training = False  # todo: refactor this part to go in the config
@@ -315,10 +320,10 @@ def replace_transformer_layer(orig_layer_impl, model, checkpoint_dict, config, m
             module.lm_head.weight = embedding_weight
         # enable tensor parallel for the last linear
         if hasattr(module, "lm_head") and hasattr(module.lm_head, "weight") and not module.lm_head.weight.is_meta:
-            module = replace_wo_policy(module, ("lm_head", ), 0, "lm_head")
+            module = replace_wo_policy(module, ("lm_head", ))
         elif hasattr(module, "embed_out") and hasattr(module.embed_out,
                                                       "weight") and not module.embed_out.weight.is_meta:
-            module = replace_wo_policy(module, ("embed_out", ), 0, "embed_out")
+            module = replace_wo_policy(module, ("embed_out", ))
         return module
 
     if checkpoint_dict is not None and not config.replace_with_kernel_inject:
@@ -563,7 +568,8 @@ def replace_module(model, orig_class, replace_fn, _replace_policy, checkpoint=No
     """
     sd = None
     if checkpoint is not None:
-        sd = torch.load(checkpoint, map_location='cpu')
+        # index the keys once for the whole checkpoint rather than once per replaced block
+        sd = IndexedStateDict(torch.load(checkpoint, map_location='cpu'))
     policy = {}
     if orig_class is not None:
         policy.update({orig_class: (replace_fn, _replace_policy)})
@@ -3,6 +3,8 @@
 
 # DeepSpeed Team
 
+import functools
+
 from deepspeed import comm as dist
 global num_kv_heads
 
@@ -10,6 +12,8 @@ global num_kv_heads
 def set_num_kv_heads(num):
     global num_kv_heads
     num_kv_heads = num
+    # cached shard sizes were computed for the previous number of kv heads
+    _get_shard_sizes.cache_clear()
 
 
 def get_num_kv_heads():
@@ -32,8 +36,11 @@ def get_shard_size(total_size, mp_size, rank=None):
             assert False, f"Number of attention heads ({total_size}) must be divisible by mp_size ({mp_size})"
 
 
+@functools.lru_cache(maxsize=None)
+def _get_shard_sizes(total_size, mp_size):
+    return tuple(get_shard_size(total_size, mp_size, i) for i in range(mp_size))
+
+
 def get_shard_size_list(total_size, mp_size):
-    shard_sizes = []
-    for i in range(mp_size):
-        shard_sizes.append(get_shard_size(total_size, mp_size, i))
-    return shard_sizes
+    # layers of the same shape share their shard sizes, so they are only computed once per shape
+    return list(_get_shard_sizes(total_size, mp_size))
@@ -0,0 +1,222 @@
+# Copyright (c) Microsoft Corporation.
+# SPDX-License-Identifier: Apache-2.0
+
+# DeepSpeed Team
+
+import glob
+import os
+import sys
+from collections import OrderedDict
+
+import pytest
+import torch
+
+from deepspeed.checkpoint import (
+    OPTIMIZER_STATE_DICT,
+    BASE_OPTIMIZER_STATE,
+    SINGLE_PARTITION_OF_FP32_GROUPS,
+    PARAM_SLICE_MAPPINGS,
+    PARAM_SHAPES,
+    PARAM,
+    CAT_DIM,
+    GROUP_PADDINGS,
+    PARTITION_COUNT,
+    VOCAB_DIVISIBILITY_PADDING_TENSOR,
+    ORIGINAL_VOCAB_SIZE,
+    UNIVERSAL_CHECKPOINT_INFO,
+    VOCABULARY_PARAMETER_PATTERNS,
+    PIPELINE_REPLICATED_PARAMETER_PATTERNS,
+    TP_REPLICATED_PARAMETER_PATTERNS,
+    PARAMETER_TO_AVERAGE_PATTERNS,
+    PARAMETER_WITH_ROW_PARALLELISM_PATTERNS,
+)
+from deepspeed.checkpoint.ds_to_universal import SHARED_MEMORY_FOLDER, ZERO_STATES, _check_replicated_slices, main
+from deepspeed.utils.tensor_fragment import fragment_address
+
+TP_DEGREE, PP_DEGREE, DP_DEGREE = 2, 2, 2
+ITERATION = 10
+# shape of every parameter's tp slice, per pipeline stage; the word embeddings are tied across the first and last stage
+STAGE_SHAPES = [
+    OrderedDict([('0.word_embeddings.weight', (5, 4)), ('1.input_layernorm.weight', (4, )),
+                 ('1.self_attention.dense.weight', (4, 3))]),
+    OrderedDict([('2.mlp.dense_h_to_4h.weight', (6, 4)), ('2.mlp.dense_h_to_4h.bias', (6, )),
+                 ('3.final_layernorm.weight', (4, )), ('3.final_layernorm.bias', (4, )),
+                 ('0.word_embeddings.weight', (5, 4))]),
+]
+# flat param groups are padded to a multiple of this, which leaves padding on the last dp partition of every stage
+GROUP_ALIGNMENT = 4 * DP_DEGREE
+UNIVERSAL_INFO = {
+    ORIGINAL_VOCAB_SIZE: 9,
+    VOCABULARY_PARAMETER_PATTERNS: [r'0\.word_embeddings\.weight'],
+    PIPELINE_REPLICATED_PARAMETER_PATTERNS: [r'0\.word_embeddings\.weight'],
+    TP_REPLICATED_PARAMETER_PATTERNS: [r'.*layernorm\.weight'],
+    PARAMETER_TO_AVERAGE_PATTERNS: [r'.*layernorm\.bias'],
+    PARAMETER_WITH_ROW_PARALLELISM_PATTERNS: [r'.*dense\.weight'],
+}
+
+
+@pytest.mark.parametrize('strict', [True, False])
+def test_check_large_replicated_slices(strict):
+    # float32 can't represent every index past 2**24 elements, e.g. a 2048x12288 position embedding
+    param = torch.randn(2048, 8193)
+    assert param.numel() > 2**24
+
+    _check_replicated_slices([param, param.clone()], strict)
+
+    other = param.clone()
+    other[-1, -1] += 1
+    with pytest.raises(AssertionError):
+        _check_replicated_slices([param, other], strict)
+
+
+def _create_tp_slices():
+    """Random tp slices of every state of every parameter, identical across tp ranks for replicated parameters."""
+    tp_slices = {state: {} for state in ZERO_STATES}
+    for shapes in STAGE_SHAPES:
+        for name, shape in shapes.items():
+            if name in tp_slices['fp32']:
+                # tied across pipeline stages
+                continue
+            num_slices = 1 if name.endswith('layernorm.weight') else TP_DEGREE
+            for state in ZERO_STATES:
+                slices = [torch.randn(shape) for _ in range(num_slices)]
+                tp_slices[state][name] = slices * (TP_DEGREE // num_slices)
+
+    return tp_slices
+
+
+def _get_slice_mappings(shapes, partition_start, partition_size):
+    mappings = OrderedDict()
+    param_start = 0
+    for name, shape in shapes.items():
+        param_end = param_start + torch.Size(shape).numel()
+        start = max(param_start, partition_start)
+        end = min(param_end, partition_start + partition_size)
+        if start < end:
+            mappings[name] = fragment_address(numel=end - start, start=start - partition_start)
+        param_start = param_end
+
+    return mappings
+
+
+def _save_zero_checkpoint(folder, tp_slices):
+    for pp_index, shapes in enumerate(STAGE_SHAPES):
+        numel = sum(torch.Size(shape).numel() for shape in shapes.values())
+        padding = -numel % GROUP_ALIGNMENT
+        partition_size = (numel + padding) // DP_DEGREE
+        for tp_index in range(TP_DEGREE):
+            mp_rank = pp_index * TP_DEGREE + tp_index
+            model_sd = {
+                PARAM_SHAPES: [OrderedDict((name, torch.Size(shape)) for name, shape in shapes.items())],
+                UNIVERSAL_CHECKPOINT_INFO: UNIVERSAL_INFO,
+                'iteration': ITERATION,
+            }
+            torch.save(model_sd, os.path.join(folder, f'mp_rank_{mp_rank:02d}_model_states.pt'))
+
+            flat_states = {
+                state:
+                torch.cat([tp_slices[state][name][tp_index].flatten() for name in shapes] + [torch.zeros(padding)])
+                for state in ZERO_STATES
+            }
+            for dp_index in range(DP_DEGREE):
+                partition_start = dp_index * partition_size
+                partitions = {
+                    state: flat_state.narrow(0, partition_start, partition_size).clone()
+                    for state, flat_state in flat_states.items()
+                }
+                optim_sd = {
+                    BASE_OPTIMIZER_STATE: {
+                        'state': {
+                            0: dict(exp_avg=partitions['exp_avg'], exp_avg_sq=partitions['exp_avg_sq'])
+                        },
+                        'param_groups': [{
+                            'lr': 0.1
+                        }],
+                    },
+                    SINGLE_PARTITION_OF_FP32_GROUPS: [partitions['fp32']],
+                    PARAM_SLICE_MAPPINGS: [_get_slice_mappings(shapes, partition_start, partition_size)],
+                    GROUP_PADDINGS: [padding if dp_index == DP_DEGREE - 1 else 0],
+                    PARTITION_COUNT: [DP_DEGREE],
+                }
+                zero_file = f'zero_pp_rank_{dp_index}_mp_rank_{mp_rank:02d}_optim_states.pt'
+                torch.save({OPTIMIZER_STATE_DICT: optim_sd}, os.path.join(folder, zero_file))
+
+    # layer files are only used to infer the tp and pp degrees
+    for layer_index in range(3):
+        for tp_index in range(TP_DEGREE):
+            torch.save({}, os.path.join(folder, f'layer_{layer_index:02d}-model_{tp_index:02d}-model_states.pt'))
+
+
+def _merge_tp_slices(name, slices):
+    """Universal parameter expected from the tp slices, and its cat dim if it is concatenated."""
+    if name.endswith('layernorm.weight'):
+        return slices[0], None
+    if name.endswith('layernorm.bias'):
+        return torch.stack(slices).mean(0), None
+    if name.endswith('dense.weight'):
+        return torch.cat(slices, 1), 1
+    return torch.cat(slices, 0), 0
+
+
+@pytest.mark.parametrize('strict_replica_check', [False, True])
+@pytest.mark.parametrize('moment_dtype', ['fp32', 'bf16'])
+@pytest.mark.parametrize('in_memory', [False, True])
+def test_convert_to_universal(tmpdir, monkeypatch, strict_replica_check, moment_dtype, in_memory):
+    input_folder = os.path.join(tmpdir, 'global_step10')
+    output_folder = os.path.join(tmpdir, 'universal', 'global_step10')
+    os.makedirs(input_folder)
+    tp_slices = _create_tp_slices()
+    _save_zero_checkpoint(input_folder, tp_slices)
+
+    args = [
+        'ds_to_universal.py', '--input_folder', input_folder, '--output_folder', output_folder,
+        '--num_extract_workers', '2', '--num_merge_workers', '2', '--moment_dtype', moment_dtype
+    ]
+    if strict_replica_check:
+        args.append('--strict_replica_check')
+    if in_memory:
+        args.append('--in_memory')
+    shared_memory_folders = set(glob.glob(os.path.join(SHARED_MEMORY_FOLDER, 'ds_to_universal_*')))
+    monkeypatch.setattr(sys, 'argv', args)
+    main()
+
+    for state in ZERO_STATES:
+        for name, slices in tp_slices[state].items():
+            if moment_dtype == 'bf16' and state != 'fp32':
+                slices = [tp_slice.to(torch.bfloat16).float() for tp_slice in slices]
+            expected, cat_dim = _merge_tp_slices(name, slices)
+
+            ckpt = torch.load(os.path.join(output_folder, 'zero', name, f'{state}.pt'))
+            assert ckpt[PARAM].dtype == torch.float32
+            torch.testing.assert_close(ckpt[PARAM], expected)
+            assert ckpt.get(CAT_DIM) == cat_dim
+            if name == '0.word_embeddings.weight':
+                torch.testing.assert_close(ckpt[VOCAB_DIVISIBILITY_PADDING_TENSOR], expected[-1])
+
+    assert os.path.isfile(os.path.join(output_folder, 'zero', 'optimizer_state.pt'))
+    # the intermediate slice files are removed wherever they were extracted to
+    assert not os.path.exists(os.path.join(output_folder, 'tmp'))
+    assert set(glob.glob(os.path.join(SHARED_MEMORY_FOLDER, 'ds_to_universal_*'))) == shared_memory_folders
+
+
+@pytest.mark.parametrize('in_memory', [False, True])
+def test_convert_to_universal_failure_removes_temp_folder(tmpdir, monkeypatch, in_memory):
+    input_folder = os.path.join(tmpdir, 'global_step10')
+    output_folder = os.path.join(tmpdir, 'universal', 'global_step10')
+    os.makedirs(input_folder)
+    tp_slices = _create_tp_slices()
+    # tp replicas that differ fail the conversion while merging
+    replica = tp_slices['fp32']['1.input_layernorm.weight'][0]
+    tp_slices['fp32']['1.input_layernorm.weight'] = [replica, replica + 1]
+    _save_zero_checkpoint(input_folder, tp_slices)
+
+    args = ['ds_to_universal.py', '--input_folder', input_folder, '--output_folder', output_folder]
+    if in_memory:
+        args.append('--in_memory')
+    shared_memory_folders = set(glob.glob(os.path.join(SHARED_MEMORY_FOLDER, 'ds_to_universal_*')))
+    monkeypatch.setattr(sys, 'argv', args)
+    with pytest.raises(AssertionError):
+        main()
+
+    assert not os.path.exists(os.path.join(output_folder, 'tmp'))
+    assert set(glob.glob(os.path.join(SHARED_MEMORY_FOLDER, 'ds_to_universal_*'))) == shared_memory_folders
@@ -0,0 +1,222 @@
+# Copyright (c) Microsoft Corporation.
+# SPDX-License-Identifier: Apache-2.0
+
+# DeepSpeed Team
+
+import pytest
+import torch
+from deepspeed.accelerator import get_accelerator
+from deepspeed.module_inject.auto_tp import AutoTP, IndexedStateDict, Loading, ReplaceWithTensorSlicing
+from deepspeed.module_inject.fusedqkv_utils import prepare_tp_fused_qkvw, prepare_tp_fused_qkvw_pair
+from deepspeed.module_inject.tp_shard import set_num_kv_heads
+from unit.common import DistributedTest
+
+
+@pytest.mark.parametrize('indexed', [True, False])
+def test_state_dict_prefix(indexed):
+    state_dict = {
+        "model.layers.0.mlp.weight": torch.zeros(1),
+        "model.layers.1.mlp.weight": torch.zeros(1),
+        "model.norm.weight": torch.zeros(1),
+    }
+    if indexed:
+        state_dict = IndexedStateDict(state_dict)
+    autotp = AutoTP(torch.nn.Module(), (), "model", state_dict, None, None)
+
+    assert autotp._has_state_dict_prefix("model.layers.0.")
+    assert autotp._has_state_dict_prefix("model.layers.1.mlp.")
+    assert autotp._has_state_dict_prefix("model.norm.")
+    assert not autotp._has_state_dict_prefix("model.layers.2.")
+    assert not autotp._has_state_dict_prefix("layers.0.")
+
+
+def test_load_meta_norm_uses_state_dict_tensors():
+    # values that are used as they are must not materialize the meta tensors they replace
+    with torch.device('meta'):
+        norm = torch.nn.LayerNorm(8)
+    state_dict = {'norm.weight': torch.randn(8), 'norm.bias': torch.randn(8)}
+
+    Loading.load(norm, state_dict, 'norm.')
+
+    assert norm.weight.data_ptr() == state_dict['norm.weight'].data_ptr()
+    assert norm.bias.data_ptr() == state_dict['norm.bias'].data_ptr()
+
+
+def test_load_meta_linear_uses_state_dict_tensors():
+    # full weights are left on the host for AutoTP to shard, rather than copied to the device by every rank
+    with torch.device('meta'):
+        linear = torch.nn.Linear(4, 8)
+    state_dict = {'linear.weight': torch.randn(8, 4), 'linear.bias': torch.randn(8)}
+
+    Loading.load(linear, state_dict, 'linear.')
+
+    assert linear.weight.data_ptr() == state_dict['linear.weight'].data_ptr()
+    assert linear.bias.data_ptr() == state_dict['linear.bias'].data_ptr()
+
+
+def test_load_meta_linear_casts_state_dict_tensors():
+    with torch.device('meta'):
+        linear = torch.nn.Linear(4, 8, dtype=torch.float16)
+    state_dict = {'linear.weight': torch.randn(8, 4), 'linear.bias': torch.randn(8)}
+
+    Loading.load(linear, state_dict, 'linear.')
+
+    assert linear.weight.device.type == 'cpu' and linear.weight.dtype == torch.float16
+    assert torch.equal(linear.weight, state_dict['linear.weight'].half())
+    assert torch.equal(linear.bias, state_dict['linear.bias'].half())
+
+
+@pytest.mark.skipif(not get_accelerator().is_available(), reason="requires an accelerator")
+def test_copy_shard_into_meta():
+    # only a shard is written into a meta dst, so it is materialized on the accelerator at the shard's size
+    src = torch.randn(8, 4)
+    mp_replace = ReplaceWithTensorSlicing()
+    mp_replace.gpu_index = 1
+
+    dst = mp_replace.copy(torch.empty(4, 4, device='meta'), src)
+
+    assert dst.device.type != 'cpu'
+    assert torch.equal(dst.cpu(), src[4:])
+
+
+class T5Attention(torch.nn.Module):
+
+    def __init__(self, hidden):
+        super().__init__()
+        self.q = torch.nn.Linear(hidden, hidden, bias=False)
+        self.k = torch.nn.Linear(hidden, hidden, bias=False)
+        self.v = torch.nn.Linear(hidden, hidden, bias=False)
+        self.o = torch.nn.Linear(hidden, hidden, bias=False)
+
+
+class T5LayerAttention(torch.nn.Module):
+
+    def __init__(self, name, hidden):
+        super().__init__()
+        setattr(self, name, T5Attention(hidden))
+        self.layer_norm = torch.nn.LayerNorm(hidden)
+
+
+class T5DenseReluDense(torch.nn.Module):
+
+    def __init__(self, hidden):
+        super().__init__()
+        self.wi = torch.nn.Linear(hidden, 4 * hidden, bias=False)
+        self.wo = torch.nn.Linear(4 * hidden, hidden, bias=False)
+
+
+class T5LayerFF(torch.nn.Module):
+
+    def __init__(self, hidden):
+        super().__init__()
+        self.DenseReluDense = T5DenseReluDense(hidden)
+        self.layer_norm = torch.nn.LayerNorm(hidden)
+
+
+class T5Block(torch.nn.Module):
+
+    def __init__(self, hidden, is_decoder):
+        super().__init__()
+        self.layer = torch.nn.ModuleList([T5LayerAttention('SelfAttention', hidden)])
+        if is_decoder:
+            self.layer.append(T5LayerAttention('EncDecAttention', hidden))
+        self.layer.append(T5LayerFF(hidden))
+
+
+class T5Stack(torch.nn.Module):
+
+    def __init__(self, hidden, is_decoder):
+        super().__init__()
+        self.block = torch.nn.ModuleList([T5Block(hidden, is_decoder) for _ in range(2)])
+
+
+class T5Model(torch.nn.Module):
+
+    def __init__(self, hidden=8):
+        super().__init__()
+        self.encoder = T5Stack(hidden, is_decoder=False)
+        self.decoder = T5Stack(hidden, is_decoder=True)
+
+
+def test_tp_parser_encoder_decoder():
+    # encoder and decoder blocks share their type, only the decoder blocks have cross attention
+    model = T5Model()
+
+    module_list = AutoTP.get_module_list(model)
+    assert module_list == [model.encoder.block[0], model.decoder.block[0]]
+
+    policy_list = AutoTP.tp_parser(model)
+    assert len(policy_list) == 1
+    module_type, gems = policy_list[0]
+    assert module_type is T5Block
+    assert sorted(gems) == ['DenseReluDense.wo', 'EncDecAttention.o', 'SelfAttention.o']
+
+
+def _split_cat_qkv_shard(src, num_splits, qkv_size, dim, gpu_index):
+    # shard selection of strided_copy before it was rewritten as a strided view
+    src_split = torch.split(src, src.shape[dim] // num_splits, dim=dim)
+    qkv_split = [torch.split(src_s, qkv_size, dim=dim) for src_s in src_split]
+    return torch.cat([qkv_s[gpu_index] for qkv_s in qkv_split], dim=dim)
+
+
+@pytest.mark.parametrize('tp_size', [1, 2, 4])
+@pytest.mark.parametrize('int8', [False, True])
+def test_strided_copy_qkv_weight(tp_size, int8):
+    hidden, num_splits = 16, 3
+    outer_dim = 0 if int8 else -1
+    src = torch.randn(num_splits * hidden, hidden) if int8 else torch.randn(hidden, num_splits * hidden)
+    for gpu_index in range(tp_size):
+        mp_replace = ReplaceWithTensorSlicing(out_dim=0 if int8 else 1)
+        mp_replace.gpu_index = gpu_index
+        dst_shape = list(src.shape)
+        dst_shape[outer_dim] //= tp_size
+        dst = mp_replace.strided_copy(torch.empty(dst_shape), src, num_splits=num_splits, int8=int8)
+
+        expected = _split_cat_qkv_shard(src, num_splits, hidden // tp_size, outer_dim, gpu_index)
+        assert torch.equal(dst.data, expected)
+
+
+@pytest.mark.parametrize('tp_size', [2, 4])
+def test_strided_copy_qkv_bias(tp_size):
+    hidden, num_splits = 16, 3
+    src = torch.randn(num_splits * hidden)
+    for gpu_index in range(tp_size):
+        mp_replace = ReplaceWithTensorSlicing()
+        mp_replace.gpu_index = gpu_index
+        dst = mp_replace.strided_copy(torch.empty(num_splits * hidden // tp_size), src, num_splits=num_splits)
+
+        expected = _split_cat_qkv_shard(src, num_splits, hidden // tp_size, 0, gpu_index)
+        assert torch.equal(dst.data, expected)
+
+
+@pytest.mark.parametrize('tp_size', [2, 4])
+@pytest.mark.parametrize('module_str',
+                         ['CodeGenBlock', 'BloomBlock', 'GLMBlock', 'MPTBlock', 'QWenBlock', 'GPTBigCodeBlock'])
+class TestFusedQKVPair(DistributedTest):
+    # codegen shards by the current rank's number of kv heads, which needs an initialized process group
+    world_size = 1
+
+    def test_pair_matches_separate_calls(self, module_str, tp_size):
+        hidden = 32
+        weight = torch.randn(3 * hidden, hidden)
+        # the codegen layout is only defined for weights
+        bias = None if module_str == 'CodeGenBlock' else torch.randn(3 * hidden)
+        set_num_kv_heads(16 if module_str == 'CodeGenBlock' else None)
+        try:
+            weight_shards = []
+            for gpu_index in range(tp_size):
+                weight_shard, bias_shard = prepare_tp_fused_qkvw_pair(module_str, weight, bias, tp_size, gpu_index)
+
+                assert torch.equal(weight_shard, prepare_tp_fused_qkvw(module_str, weight, tp_size, gpu_index))
+                if bias is None:
+                    assert bias_shard is None
+                else:
+                    assert torch.equal(bias_shard, prepare_tp_fused_qkvw(module_str, bias, tp_size, gpu_index))
+                weight_shards.append(weight_shard)
+        finally:
+            set_num_kv_heads(None)
+
+        # the shards of all ranks partition the rows of the fused weight
+        all_rows = torch.cat(weight_shards)
+        assert all_rows.shape == weight.shape
+        assert torch.equal(all_rows.sort(dim=0).values, weight.sort(dim=0).values)